@@ -1,24 +1,195 @@
 import streamlit as st
-import os
-import base64
+import functools
+import hashlib
 import re
+import threading
+import time
+from collections import deque
+import httpx
 import pandas as pd
 import fitz
-from PIL import Image
-from together import Together
+try:
+    import pybase64 as base64  # SIMD-accelerated, same API as the stdlib module
+except ImportError:
+    import base64
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
+from together import (
+    Together, DefaultHttpxClient, APIStatusError, RateLimitError, APIConnectionError, InternalServerError
+)
+
+
+REQUEST_TIMEOUT = 60
+# Extra time allowed per image on multi-image requests, which generate N answers
+BATCH_TIMEOUT_PER_IMAGE = 15
+
+_NUM_LINE_RE = re.compile(r"^[ \t]*\**[ \t]*([^:*]+?)\**[ \t]*:[ \t]*(.+?)[ \t]*$")
+_NUM_CLEAN_RE = re.compile(r"[^\d.\-]")
+_BATCH_SPLIT_RE = re.compile(r"^[ \t]*-{3,}[ \t]*$", re.MULTILINE)
+
+_BATCH_PROMPT = """You are given {count} separate financial documents, one per image, in order.
+Apply the following instructions to each image independently:
+
+{prompt}
+
+Answer for every image in the same order as the images.
+Separate the answers for consecutive images with a line containing only ---"""
+
+
+class RateLimiter:
+    """Sliding-window limiter shared by all threads calling the Together API."""
+
+    def __init__(self, max_calls=60, period=60.0):
+        self.max_calls = max_calls
+        self.period = period
+        self.calls = deque()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                while self.calls and now - self.calls[0] >= self.period:
+                    self.calls.popleft()
+                if len(self.calls) < self.max_calls:
+                    self.calls.append(now)
+                    return
+                wait = self.period - (now - self.calls[0])
+            time.sleep(wait)
+
+
+class ParameterParseError(ValueError):
+    """Raised when a model response contains no parseable parameters."""
+
+    def __init__(self, extracted_text):
+        super().__init__(f"No parameters found in text: {extracted_text}")
+        self.extracted_text = extracted_text
+
+
+def _log_retry(retry_state):
+    # Shown once as a warning by the app, a retry that later succeeds is not an error
+    st.session_state.retry_notices.append(
+        f"Together API call failed ({retry_state.outcome.exception()}), "
+        f"retrying (attempt {retry_state.attempt_number + 1})"
+    )
 
 
 class DocumentProcessor:
+    _PROMPTS = {
+        "Bank Statement": """Analyze this financial document carefully. Extract the most significant numeric financial parameters:
+        - Look for balance, credits, debits, and other key monetary values.
+        - Be flexible in parameter identification.
+        - Return ONLY 5 numeric values with clear labels, one per line.   
+
+        The output format should be:
+        Total Balance: 5000.50
+        Monthly Credits: 3200.75
+        Monthly Debits: 2800.25
+        Opening Balance: 4500.00
+        Closing Balance: 5200.75
+        Do not include any statements or additional text.""",
+
+        "Cheques": """Extract key details from the cheque:
+        - Focus on numeric values.
+        - Include cheque number, amount, date, and account details.
+        - Provide ONLY 5 clear, labeled values, one per line.
+
+        The output format should be:
+        Cheque Number: 123456
+        Amount: 5000.00
+        Date Timestamp: 1701907200
+        Bank Account: 9876
+        Transaction Value: 5000.00
+        Do not include any statements or additional text.""",
+
+        "Profit and Loss Statement": """Extract critical financial metrics from the Profit and Loss statement:
+        - Total Revenue
+        - Total Expenses
+        - Gross Profit
+        - Net Profit
+        - Operating Expenses
+        Return ONLY 5 clear, labeled numeric values, one per line.
+
+        The output format should be:
+        Total Revenue: 100000.00
+        Total Expenses: 75000.00
+        Gross Profit: 25000.00
+        Net Profit: 20000.00
+        Operating Expenses: 5000.00
+        Do not include any statements or additional text.""",
+
+        "Salary Slip": """Extract key salary details from the salary slip:
+        - Basic Salary
+        - Total Allowances
+        - Total Deductions
+        - Net Salary
+        - Gross Salary
+        Return ONLY 5 clear, labeled numeric values, one per line.
+
+        The output format should be:
+        Basic Salary: 30000.00
+        Total Allowances: 5000.00
+        Total Deductions: 2000.00
+        Net Salary: 27000.00
+        Gross Salary: 32000.00
+        Do not include any statements or additional text.""",
+
+        "Transaction History": """Extract summary transaction metrics from the transaction history:
+        - Total Number of Transactions
+        - Total Credits
+        - Total Debits
+        - Highest Single Transaction Amount
+        - Average Transaction Amount
+        Return ONLY 5 clear, labeled numeric values, one per line.
+
+        The output format should be:
+        Total Number of Transactions: 150
+        Total Credits: 50000.00
+        Total Debits: 30000.00
+        Highest Single Transaction Amount: 10000.00
+        Average Transaction Amount: 400.00
+        Do not include any statements or additional text."""
+    }
+
     def __init__(self):
         self.model = "meta-llama/Llama-3.2-11B-Vision-Instruct-Turbo"
-        self.client = Together(api_key=st.secrets["together"]["TOGETHER_API_KEY"])
+        self.client = Together(
+            api_key=st.secrets["together"]["TOGETHER_API_KEY"],
+            timeout=REQUEST_TIMEOUT,
+            # Retries are handled by the tenacity decorator on complete(), so the
+            # SDK's own retry loop is disabled to keep attempts from multiplying
+            max_retries=0,
+            # Keep connections to the API alive across calls and worker threads
+            http_client=DefaultHttpxClient(
+                limits=httpx.Limits(max_connections=10, max_keepalive_connections=10, keepalive_expiry=60)
+            ),
+        )
+        # Together's requests-per-minute cap for the serverless vision models
+        self.rate_limiter = RateLimiter(max_calls=60, period=60.0)
+
+    @retry(
+        stop=stop_after_attempt(3),
+        wait=wait_exponential(multiplier=0.3, max=5),
+        retry=retry_if_exception_type((RateLimitError, APIConnectionError, InternalServerError)),
+        before_sleep=_log_retry,
+        reraise=True,
+    )
+    def complete(self, content, max_tokens, timeout=REQUEST_TIMEOUT):
+        self.rate_limiter.acquire()
+        return self.client.chat.completions.create(
+            model=self.model,
+            messages=[{"role": "user", "content": content}],
+            max_tokens=max_tokens,
+            temperature=0.3,
+            timeout=timeout,
+        )
+
+    def encode_bytes(self, data):
+        return base64.b64encode(data).decode('ascii')
 
     def encode_image(self, image_path):
         try:
             with open(image_path, "rb") as image_file:
-                encoded_image = base64.b64encode(image_file.read()).decode('utf-8')
-
-                return encoded_image
+                return self.encode_bytes(image_file.read())
         except FileNotFoundError:
             st.error(f"Image not found: {image_path}")
             return None
@@ -26,146 +197,131 @@ class DocumentProcessor:
             st.error(f"Error encoding image: {e}")
             return None
 
-    def extract_parameters(self, image_path, document_type):
-
-        # Validate image path
-        if not os.path.exists(image_path):
-            st.error(f"Image path does not exist: {image_path}")
-            return None, "Image file not found"
-
-        encoded_image = self.encode_image(image_path)
-
-        if not encoded_image:
-            st.error("Image could not be encoded")
-            return None, "Image encoding failed"
-
-        prompts = {
-            "Bank Statement": """Analyze this financial document carefully. Extract the most significant numeric financial parameters:
-            - Look for balance, credits, debits, and other key monetary values.
-            - Be flexible in parameter identification.
-            - Return ONLY 5 numeric values with clear labels, one per line.   
-
-            The output format should be:
-            Total Balance: 5000.50
-            Monthly Credits: 3200.75
-            Monthly Debits: 2800.25
-            Opening Balance: 4500.00
-            Closing Balance: 5200.75
-            Do not include any statements or additional text.""",
-
-            "Cheques": """Extract key details from the cheque:
-            - Focus on numeric values.
-            - Include cheque number, amount, date, and account details.
-            - Provide ONLY 5 clear, labeled values, one per line.
-
-            The output format should be:
-            Cheque Number: 123456
-            Amount: 5000.00
-            Date Timestamp: 1701907200
-            Bank Account: 9876
-            Transaction Value: 5000.00
-            Do not include any statements or additional text.""",
-
-            "Profit and Loss Statement": """Extract critical financial metrics from the Profit and Loss statement:
-            - Total Revenue
-            - Total Expenses
-            - Gross Profit
-            - Net Profit
-            - Operating Expenses
-            Return ONLY 5 clear, labeled numeric values, one per line.
-
-            The output format should be:
-            Total Revenue: 100000.00
-            Total Expenses: 75000.00
-            Gross Profit: 25000.00
-            Net Profit: 20000.00
-            Operating Expenses: 5000.00
-            Do not include any statements or additional text.""",
-
-            "Salary Slip": """Extract key salary details from the salary slip:
-            - Basic Salary
-            - Total Allowances
-            - Total Deductions
-            - Net Salary
-            - Gross Salary
-            Return ONLY 5 clear, labeled numeric values, one per line.
-
-            The output format should be:
-            Basic Salary: 30000.00
-            Total Allowances: 5000.00
-            Total Deductions: 2000.00
-            Net Salary: 27000.00
-            Gross Salary: 32000.00
-            Do not include any statements or additional text.""",
-
-            "Transaction History": """Extract summary transaction metrics from the transaction history:
-            - Total Number of Transactions
-            - Total Credits
-            - Total Debits
-            - Highest Single Transaction Amount
-            - Average Transaction Amount
-            Return ONLY 5 clear, labeled numeric values, one per line.
-
-            The output format should be:
-            Total Number of Transactions: 150
-            Total Credits: 50000.00
-            Total Debits: 30000.00
-            Highest Single Transaction Amount: 10000.00
-            Average Transaction Amount: 400.00
-            Do not include any statements or additional text."""
-
-        }
+    @staticmethod
+    @functools.lru_cache(maxsize=64)
+    def build_prompt(document_type, count=1):
+        # Prompts depend only on the document type and batch size, so build each once
+        prompt = DocumentProcessor._PROMPTS.get(document_type, "")
+        if count == 1:
+            return prompt
+        return _BATCH_PROMPT.format(count=count, prompt=prompt)
+
+    def extract_parameters(self, image_bytes, document_type, content_hash=None):
+
+        # Validate image data
+        if not image_bytes:
+            st.error("Image data is empty")
+            return None, "Image data not found"
+
+        encoded_image = self.encode_bytes(image_bytes)
+
+        if content_hash is None:
+            content_hash = hashlib.sha256(image_bytes).hexdigest()
+
+        content = [
+            {"type": "text", "text": self.build_prompt(document_type)},
+            {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{encoded_image}"}}
+        ]
 
         try:
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": prompts.get(document_type, "")},
-                            {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{encoded_image}"}}
-                        ]
-                    }
-                ],
-                max_tokens=300,
-                temperature=0.3
-            )
-
-            extracted_text = response.choices[0].message.content.strip()
-
-            # Robust parameter extraction
-            parameters = []
-            for line in extracted_text.split('\n'):
-                parts = line.split(":", 1)
-                if len(parts) == 2:
-                    try:
-                        parameter = parts[0].strip().strip('*')
-                        value_str = parts[1].strip()
-
-                        # More robust number cleaning
-                        cleaned_value_str = re.sub(r"[^\d,-.]", "", value_str)
-                        cleaned_value_str = cleaned_value_str.replace(',', '')  # Remove commas
-
-                        # Handle potential scientific notation or large numbers
-                        try:
-                            value = float(cleaned_value_str)
-                        except ValueError:
-                            value = cleaned_value_str
-
-                        parameters.append([parameter, value])
-
-                    except Exception as parse_error:
-                        print(f"Error parsing parameter: {parse_error}")
-
-            if not parameters:
-                st.warning(f"No parameters found in text: {extracted_text}")
-                return None, extracted_text
-
-            df = pd.DataFrame(parameters, columns=['Parameter', 'Value'])
-            return df, extracted_text
+            return self._extract(content_hash, document_type, self.model, self, content)
+
+        except ParameterParseError as e:
+            # Already reported by _parse_parameters, and left uncached so a re-upload asks the model again
+            return None, e.extracted_text
 
         except Exception as e:
             st.error(f"Comprehensive Extraction Error: {e}")
-            import traceback
-            return None, str(e)
\ No newline at end of file
+            return None, str(e)
+
+    @staticmethod
+    @st.cache_data(show_spinner=False, max_entries=256)
+    def _extract(content_hash, document_type, model, _processor, _content):
+        # Keyed on (content_hash, document_type, model); the processor and the
+        # encoded payload are excluded from hashing via the leading underscore.
+        # Failures raise instead of returning so they are never cached.
+        response = _processor.complete(_content, max_tokens=300)
+
+        extracted_text = response.choices[0].message.content.strip()
+        df = DocumentProcessor._parse_parameters(extracted_text)
+        if df is None:
+            raise ParameterParseError(extracted_text)
+        return df, extracted_text
+
+    def extract_parameters_batch(self, image_bytes_list, document_type, content_hashes=None):
+        """
+        Extract parameters from several images of the same document type in one request
+
+        Args:
+        image_bytes_list (list): Raw image bytes, one entry per document
+        document_type (str): Document type used to select the prompt
+        content_hashes (list): Optional sha256 digests of the uploads, used as cache keys
+
+        Returns:
+        list: One (DataFrame or None, extracted text) tuple per image, in input order
+
+        Raises:
+        ValueError: If the endpoint rejects the multi-image request (4xx other than 429) or the
+        response cannot be split into one parseable answer per image; callers should then
+        extract the images one by one
+        """
+        if content_hashes is None:
+            content_hashes = [hashlib.sha256(image_bytes).hexdigest() for image_bytes in image_bytes_list]
+
+        if len(image_bytes_list) == 1:
+            return [self.extract_parameters(image_bytes_list[0], document_type, content_hashes[0])]
+
+        content = [{"type": "text", "text": self.build_prompt(document_type, len(image_bytes_list))}]
+        for image_bytes in image_bytes_list:
+            encoded_image = self.encode_bytes(image_bytes)
+            content.append({"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{encoded_image}"}})
+
+        try:
+            return self._extract_batch(tuple(content_hashes), document_type, self.model, self, content)
+        except (RateLimitError, InternalServerError):
+            raise
+        except APIStatusError as e:
+            # e.g. a model served with a one-image-per-prompt limit answers 400
+            if e.status_code >= 500:
+                raise
+            raise ValueError(f"Batch request rejected: {e}") from e
+
+    @staticmethod
+    @st.cache_data(show_spinner=False, max_entries=64)
+    def _extract_batch(content_hashes, document_type, model, _processor, _content):
+        response = _processor.complete(
+            _content,
+            max_tokens=300 * len(content_hashes),
+            timeout=REQUEST_TIMEOUT + BATCH_TIMEOUT_PER_IMAGE * len(content_hashes),
+        )
+        extracted_text = response.choices[0].message.content.strip()
+
+        blocks = [block.strip() for block in _BATCH_SPLIT_RE.split(extracted_text) if block.strip()]
+        if len(blocks) != len(content_hashes):
+            raise ValueError(f"Expected {len(content_hashes)} blocks in batch response, got {len(blocks)}")
+
+        results = []
+        for block in blocks:
+            df = DocumentProcessor._parse_parameters(block)
+            if df is None:
+                raise ParameterParseError(block)
+            results.append((df, block))
+        return results
+
+    @staticmethod
+    def _parse_parameters(extracted_text):
+        # Robust parameter extraction, one vectorized pass over all lines
+        parts = pd.Series(extracted_text.splitlines(), dtype=object).str.extract(_NUM_LINE_RE).dropna()
+        parts[0] = parts[0].str.strip()
+        # Keep digits, decimal point and sign only (drops currency symbols and commas).
+        # Non-numeric values are dropped here, so Value is always a float64 column.
+        parts[1] = pd.to_numeric(
+            parts[1].str.replace(_NUM_CLEAN_RE, "", regex=True), errors='coerce'
+        ).astype('float64')
+        parts = parts.dropna()
+
+        if parts.empty:
+            st.warning(f"No parameters found in text: {extracted_text}")
+            return None
+
+        return parts.rename(columns={0: 'Parameter', 1: 'Value'}).reset_index(drop=True)
@@ -1,17 +1,16 @@
 import streamlit as st
 import os
 import io
+import hashlib
 import tempfile
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import fitz
-from PIL import Image
 import pandas as pd
-import base64
-import requests
 from dotenv import load_dotenv
 import random
 import zipfile
-from urllib3.util.retry import Retry
-from requests.adapters import HTTPAdapter
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from document_processor import DocumentProcessor
 from visualizations import visualize_comparative_data, process_comparative_data, create_interactive_pie_chart
 
@@ -22,6 +21,10 @@ if 'temp_image_paths' not in st.session_state:
     st.session_state.temp_image_paths = []
 if 'processing_errors' not in st.session_state:
     st.session_state.processing_errors = []
+if 'retry_notices' not in st.session_state:
+    st.session_state.retry_notices = []
+if 'encoded_images' not in st.session_state:
+    st.session_state.encoded_images = {}
 if 'cloudinary_images' not in st.session_state:
     st.session_state.cloudinary_images = []
 
@@ -31,34 +34,6 @@ load_dotenv()
 
 
 
-def create_requests_session(retries=3, backoff_factor=0.3, status_forcelist=(500, 502, 504)):
-    session = requests.Session()
-    retry = Retry(
-        total=retries,
-        read=retries,
-        connect=retries,
-        backoff_factor=backoff_factor,
-        status_forcelist=status_forcelist,
-    )
-    adapter = HTTPAdapter(max_retries=retry)
-    session.mount('http://', adapter)
-    session.mount('https://', adapter)
-    return session
-
-
-def download_image(url, session=None):
-    if session is None:
-        session = requests.Session()
-    try:
-        response = session.get(url, timeout=(10, 30))
-        return response.content if response.status_code == 200 else None
-    except requests.exceptions.RequestException:
-        return None
-
-
-
-
-
 def create_zip_file(images):
     zip_buffer = io.BytesIO()
     with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
@@ -67,36 +42,171 @@ def create_zip_file(images):
     return zip_buffer.getvalue()
 
 
+MAX_WORKERS = 5
+MAX_BATCH_SIZE = 10
+PDF_RENDER_DPI = 150
+PDF_JPEG_QUALITY = 85
+
+
+def _embedded_page_image(doc, page):
+    """Return the page's embedded raster if the page is a text-free scan of a single image."""
+    images = page.get_images(full=True)
+    if len(images) != 1 or page.rotation:
+        return None
+
+    # Vector text drawn over the image would be lost without a full render
+    if page.get_text("text").strip():
+        return None
+
+    xref, smask = images[0][0], images[0][1]
+    if smask:  # The alpha channel lives in a separate image, needs compositing
+        return None
+
+    placements = page.get_image_rects(xref, transform=True)
+    if len(placements) != 1:
+        return None
+
+    # The raw bytes are only usable if the image is drawn upright, unflipped and full-page
+    rect, matrix = placements[0]
+    if matrix.b or matrix.c or matrix.a <= 0 or matrix.d <= 0:
+        return None
+    if rect.get_area() < 0.9 * page.rect.get_area():
+        return None
+
+    extracted = doc.extract_image(xref)
+    if not extracted or extracted["ext"] not in ("jpeg", "png"):
+        return None
+
+    # CMYK, inverted Adobe DCT and spot-colour scans must be converted by get_pixmap
+    if extracted["colorspace"] not in (1, 3) or extracted.get("cs-name", "").startswith(("Separation", "DeviceN")):
+        return None
+    return extracted
+
+
+def _pdf_page_image(doc, page_number):
+    page = doc[page_number]
+
+    # Scanned statements are one raster per page, reuse it instead of re-rendering
+    extracted = _embedded_page_image(doc, page)
+    if extracted:
+        return extracted["image"], ".jpg" if extracted["ext"] == "jpeg" else f".{extracted['ext']}"
+
+    pix = page.get_pixmap(dpi=PDF_RENDER_DPI)
+    return pix.tobytes("jpeg", jpg_quality=PDF_JPEG_QUALITY), ".jpg"
+
+
+def _prepare_one(uploaded_file):
+    suffix = os.path.splitext(uploaded_file.name)[1]
+    if suffix.lower() == ".pdf":
+        with fitz.open(stream=uploaded_file.getvalue(), filetype="pdf") as doc:
+            image_bytes, suffix = _pdf_page_image(doc, 0)
+    else:
+        image_bytes = uploaded_file.getvalue()
+
+    # Only the query section reads the image back, extraction uses the bytes
+    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as temp_file:
+        temp_file.write(image_bytes)
+        image_path = temp_file.name
+
+    return image_path, image_bytes
+
+
 def process_uploaded_files(uploaded_files, processor, selected_doc_type):
     if not st.session_state.processed_dfs:  # Only process if not already processed
-        for uploaded_file in uploaded_files:
-            try:
-                with tempfile.NamedTemporaryFile(delete=False,
-                                                 suffix=os.path.splitext(uploaded_file.name)[1]) as temp_file:
-                    temp_file.write(uploaded_file.getvalue())
-                    temp_path = temp_file.name
-
-                if os.path.splitext(uploaded_file.name)[1].lower() == ".pdf":
-                    with fitz.open(stream=uploaded_file.getvalue(), filetype="pdf") as doc:
-                        page = doc[0]
-                        pix = page.get_pixmap()
-                        img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-                        temp_image_path = f"{temp_path}_page_0.png"
-                        img.save(temp_image_path)
-                        st.session_state.temp_image_paths.append(temp_image_path)
-                else:
-                    st.session_state.temp_image_paths.append(temp_path)
-
-                df, _ = processor.extract_parameters(st.session_state.temp_image_paths[-1], selected_doc_type)
-
-                if df is not None and all(col in df.columns for col in ["Parameter", "Value"]):
-                    df["Document"] = uploaded_file.name if len(uploaded_files) > 1 else "Default Document"
-                    st.session_state.processed_dfs.append(df)
-                else:
-                    st.session_state.processing_errors.append(f"Invalid DataFrame format for {uploaded_file.name}")
-
-            except Exception as e:
-                st.session_state.processing_errors.append(f"Error processing {uploaded_file.name}: {str(e)}")
+        # Worker threads need the script context to emit st.error/st.warning
+        ctx = get_script_run_ctx()
+        results = {}
+        with st.status("Extracting parameters...", expanded=True) as status, ThreadPoolExecutor(
+                max_workers=min(len(uploaded_files), MAX_WORKERS),
+                initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx),
+        ) as executor:
+            progress = st.progress(0.0)
+            done = 0
+
+            # PyMuPDF is not thread-safe and rendering is CPU-bound, so prepare in the script thread
+            prepared = {}
+            for idx, uploaded_file in enumerate(uploaded_files):
+                try:
+                    prepared[idx] = _prepare_one(uploaded_file)
+                except Exception as e:
+                    results[idx] = e
+                    st.write(f"Failed {uploaded_files[idx].name}")
+                    done += 1
+
+            # Identical uploads hit the extraction cache instead of the API
+            content_hashes = {
+                idx: hashlib.sha256(uploaded_files[idx].getvalue()).hexdigest()
+                for idx in prepared
+            }
+
+            def submit(batch):
+                return executor.submit(
+                    processor.extract_parameters_batch,
+                    [prepared[idx][1] for idx in batch],
+                    selected_doc_type,
+                    [content_hashes[idx] for idx in batch],
+                )
+
+            # Batch only once every worker has a request in flight, at most MAX_BATCH_SIZE images each
+            ready = sorted(prepared)
+            batch_size = min(MAX_BATCH_SIZE, max(1, -(-len(ready) // MAX_WORKERS)))
+            pending = {}
+            for start in range(0, len(ready), batch_size):
+                batch = ready[start:start + batch_size]
+                pending[submit(batch)] = batch
+
+            while pending:
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    batch = pending.pop(future)
+                    try:
+                        outputs = future.result()
+                    except ValueError:
+                        # Rejected or malformed batch, extract those documents one by one in parallel
+                        st.write(f"Retrying {len(batch)} documents individually")
+                        for idx in batch:
+                            pending[submit([idx])] = [idx]
+                        continue
+                    except Exception as e:
+                        for idx in batch:
+                            results[idx] = e
+                            st.write(f"Failed {uploaded_files[idx].name}")
+                    else:
+                        for idx, (df, _) in zip(batch, outputs):
+                            results[idx] = (prepared[idx][0], df)
+                            st.write(f"Extracted {uploaded_files[idx].name}")
+
+                    done += len(batch)
+                    progress.progress(done / len(uploaded_files), text=f"{done}/{len(uploaded_files)} documents processed")
+
+            status.update(label="Extraction complete", state="complete", expanded=False)
+
+        # Collect in upload order so the charts and query list stay deterministic
+        for idx, uploaded_file in enumerate(uploaded_files):
+            result = results[idx]
+            if isinstance(result, Exception):
+                st.session_state.processing_errors.append(f"Error processing {uploaded_file.name}: {str(result)}")
+                continue
+
+            image_path, df = result
+            st.session_state.temp_image_paths.append(image_path)
+
+            if df is not None and all(col in df.columns for col in ["Parameter", "Value"]):
+                df["Document"] = uploaded_file.name if len(uploaded_files) > 1 else "Default Document"
+                st.session_state.processed_dfs.append(df)
+            else:
+                st.session_state.processing_errors.append(f"Invalid DataFrame format for {uploaded_file.name}")
+
+
+def show_retry_notices():
+    for notice in st.session_state.retry_notices:
+        st.warning(notice)
+    st.session_state.retry_notices = []
+
+
+@st.cache_resource
+def get_processor():
+    return DocumentProcessor()
 
 
 def main():
@@ -121,10 +231,12 @@ def main():
             st.session_state.processed_dfs = []
             st.session_state.temp_image_paths = []
             st.session_state.processing_errors = []
+            st.session_state.retry_notices = []
+            st.session_state.encoded_images = {}
             st.rerun()
 
     st.header(f"{selected_doc_type} Analysis")
-    processor = DocumentProcessor()
+    processor = get_processor()
 
     # Manual Upload Section
     uploaded_files = st.file_uploader(
@@ -139,10 +251,13 @@ def main():
     # Display errors if any
     for error in st.session_state.processing_errors:
         st.error(error)
+    show_retry_notices()
 
     # Process and visualize data
     if st.session_state.processed_dfs:
         combined_df = pd.concat(st.session_state.processed_dfs, ignore_index=True)
+        # Categorical labels let the groupbys in visualizations work on integer codes
+        combined_df[['Parameter', 'Document']] = combined_df[['Parameter', 'Document']].astype('category')
 
         st.subheader("Extracted Parameters")
         st.dataframe(combined_df)
@@ -195,20 +310,21 @@ def main():
 
             if user_query:
                 try:
-                    with open(current_image_path, "rb") as img_file:
-                        encoded_image = base64.b64encode(img_file.read()).decode("utf-8")
-
-                    response = processor.client.chat.completions.create(
-                        model=processor.model,
-                        messages=[{
-                            "role": "user",
-                            "content": [
-                                {"type": "text", "text": user_query},
-                                {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{encoded_image}"}}
-                            ]
-                        }],
+                    # Every widget change reruns the script, encode each image only once
+                    image_url = st.session_state.encoded_images.get(current_image_path)
+                    if image_url is None:
+                        encoded_image = processor.encode_image(current_image_path)
+                        if not encoded_image:
+                            return  # encode_image already reported the error
+                        image_url = f"data:image/jpeg;base64,{encoded_image}"
+                        st.session_state.encoded_images[current_image_path] = image_url
+
+                    response = processor.complete(
+                        [
+                            {"type": "text", "text": user_query},
+                            {"type": "image_url", "image_url": {"url": image_url}}
+                        ],
                         max_tokens=500,
-                        temperature=0.3
                     )
 
                     st.write(response.choices[0].message.content)
@@ -216,6 +332,8 @@ def main():
                 except Exception as e:
                     st.error(f"Error processing query: {e}")
 
+                show_retry_notices()
+
 
 if __name__ == "__main__":
     main()
@@ -26,13 +26,15 @@ def process_comparative_data(df):
         return df, list(common_parameters)
 
     # Multi-document scenario
-    grouped = df.groupby(['Parameter', 'Document'])['Value'].first().unstack()
-
-    # Find parameters that appear in all documents
-    common_parameters = grouped.dropna().index
+    # Find parameters that appear in all documents using a parameter x document presence matrix
+    parameters = pd.Categorical(df['Parameter']).remove_unused_categories()
+    documents = pd.Categorical(df['Document']).remove_unused_categories()
+    presence = np.zeros((len(parameters.categories), len(documents.categories)), dtype=bool)
+    presence[parameters.codes, documents.codes] = True
+    common_parameters = parameters.categories[presence.all(axis=1)]
 
     # Prepare long-format dataframe for visualization
-    processed_df = df[df['Parameter'].isin(common_parameters)].copy()
+    processed_df = df.loc[df['Parameter'].isin(common_parameters)]
 
     return processed_df, list(common_parameters)
 